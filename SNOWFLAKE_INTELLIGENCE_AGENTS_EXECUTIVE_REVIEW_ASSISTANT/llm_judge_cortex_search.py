@@ -12,21 +12,68 @@ Evaluation Criteria:
 
 Usage:
     python llm_judge_cortex_search.py <response_file> <question> <output_file>
+    python llm_judge_cortex_search.py <response_dir> <question_map> <output_dir>
+
+In directory mode every *_response.json in <response_dir> is judged in a single Cortex
+call and <output_dir> receives the matching *_judgment.json files. Each response is
+judged against its own question, looked up by file name in <question_map>: a JSON list
+of {"response_file": ..., "question": ...} entries such as evals/evaluation_summary.json.
+Responses without an entry are skipped.
+
+Requirements:
+    pip install snowflake-connector-python orjson
+    # single-file mode also calls Cortex through the Python API:
+    pip install snowflake-snowpark-python snowflake-ml-python
 """
 
+import glob
+import hashlib
 import json
 import sys
 import os
+import orjson
 import snowflake.connector
-from typing import Dict, Any
+from typing import TYPE_CHECKING, Dict, Any, Iterator, List, Optional, Tuple
 
-JUDGE_PROMPT = """You are an expert evaluator assessing the quality of case study search results from a Cortex Agent.
+# Snowpark and snowflake.cortex are only needed for single judgments; they are imported
+# on first use so the batch path runs with just the connector
+if TYPE_CHECKING:
+    from snowflake.snowpark import Session
 
-**User Question:** {question}
+JUDGE_MODEL = "claude-3-5-sonnet"
 
-**Agent Response:** {agent_response}
+# Verdicts are cached on disk, keyed by a hash of the model, prompt version and judge inputs
+JUDGE_CACHE_DIR = ".judge_cache"
+
+# Bump when the judge prompts change so verdicts cached for the old wording are not reused
+JUDGE_PROMPT_VERSION = 1
+
+CASE_STUDY_SEPARATOR = "\n\n---\n\n"
+
+# Minimum Jaccard overlap with the previous case study set for a delta judgment
+DELTA_OVERLAP_THRESHOLD = 0.8
+
+# Last full judgment per question: {question_hash: {"blocks": set, "verdict": dict}}
+_judge_sessions: Dict[str, Dict[str, Any]] = {}
 
-**Case Studies Retrieved (from tool results):** {case_studies}
+# Connections and Snowpark sessions opened so far, keyed by connection name
+_connections: Dict[str, snowflake.connector.SnowflakeConnection] = {}
+_sessions: Dict[str, "Session"] = {}
+
+# The judge prompt is kept as literal chunks around its three inputs
+_JUDGE_PROMPT_HEAD = """You are an expert evaluator assessing the quality of case study search results from a Cortex Agent.
+
+**User Question:** """
+
+_JUDGE_PROMPT_AFTER_QUESTION = """
+
+**Agent Response:** """
+
+_JUDGE_PROMPT_AFTER_RESPONSE = """
+
+**Case Studies Retrieved (from tool results):** """
+
+_JUDGE_PROMPT_TAIL = """
 
 Evaluate the agent's response on these 5 dimensions (score 1-5 for each):
 
@@ -75,34 +122,75 @@ Also provide:
 - **Areas for Improvement** (2-3 bullet points)
 
 Return your evaluation in JSON format:
-{{
-  "relevance": {{"score": X, "justification": "..."}},
-  "completeness": {{"score": X, "justification": "..."}},
-  "actionability": {{"score": X, "justification": "..."}},
-  "evidence_quality": {{"score": X, "justification": "..."}},
-  "synthesis": {{"score": X, "justification": "..."}},
+{
+  "relevance": {"score": X, "justification": "..."},
+  "completeness": {"score": X, "justification": "..."},
+  "actionability": {"score": X, "justification": "..."},
+  "evidence_quality": {"score": X, "justification": "..."},
+  "synthesis": {"score": X, "justification": "..."},
   "overall_score": X.X,
   "key_strengths": ["...", "...", "..."],
   "areas_for_improvement": ["...", "...", "..."]
-}}
+}
+"""
+
+DELTA_PROMPT = """You are an expert evaluator assessing the quality of case study search results from a Cortex Agent.
+
+A previous evaluation was made for the same question against a case study set that overlaps the current one.
+Only the case studies that were not part of that set are included below.
+
+**User Question:** {question}
+
+**Agent Response:** {agent_response}
+
+**Previous Evaluation:** {prior_verdict}
+
+**Additional Case Studies Retrieved (from tool results):** {new_case_studies}
+
+Re-evaluate the agent response on the same 5 dimensions (relevance, completeness, actionability,
+evidence_quality, synthesis), scoring each 1-5 with a brief justification. Start from the previous
+evaluation and adjust it for the agent response and the additional case studies.
+
+Return your evaluation in the same JSON format as the previous evaluation.
 """
 
 
-def extract_case_studies_from_response(response_data: Dict[str, Any]) -> str:
-    """Extract case study search results from response JSON."""
-    case_studies = []
+def build_prompt(question: str, agent_response: str, case_studies: str) -> str:
+    """Assemble the full judge prompt."""
+    return (
+        _JUDGE_PROMPT_HEAD + question
+        + _JUDGE_PROMPT_AFTER_QUESTION + agent_response
+        + _JUDGE_PROMPT_AFTER_RESPONSE + case_studies
+        + _JUDGE_PROMPT_TAIL
+    )
+
+
+def _iter_case_study_texts(response_data: Dict[str, Any]) -> Iterator[str]:
+    """Yield the text of each Cortex Search result in the response."""
+    for item in response_data.get("content", ()):
+        if item.get("type") != "tool_result":
+            continue
+        tool_result = item.get("tool_result") or {}
+        if "cortex_search" not in (tool_result.get("name") or ""):
+            continue
+        for c in tool_result.get("content", ()):
+            result_json = c.get("json")
+            if result_json and "search_results" in result_json:
+                for result in result_json["search_results"]:
+                    yield result.get("text", "")
+
+
+def extract_case_studies_from_response(response_data: Dict[str, Any]) -> Tuple[str, int]:
+    """Extract case study search results from response JSON.
     
-    for item in response_data.get("content", []):
-        if item.get("type") == "tool_result":
-            tool_result = item.get("tool_result", {})
-            if "cortex_search" in str(tool_result.get("name", "")):
-                content = tool_result.get("content", [])
-                for c in content:
-                    if "json" in c and "search_results" in c["json"]:
-                        for result in c["json"]["search_results"]:
-                            case_studies.append(result.get("text", ""))
+    Returns the joined case studies and how many were found.
+    """
+    # str.join materializes its argument anyway, so keep the list for the count
+    texts = list(_iter_case_study_texts(response_data))
     
-    return "\n\n---\n\n".join(case_studies) if case_studies else "No case studies found in tool results"
+    if not texts:
+        return "No case studies found in tool results", 0
+    return CASE_STUDY_SEPARATOR.join(texts), len(texts)
 
 
 def extract_agent_response(response_data: Dict[str, Any]) -> str:
@@ -113,92 +201,289 @@ def extract_agent_response(response_data: Dict[str, Any]) -> str:
     return "No agent response found"
 
 
-def call_llm_judge(question: str, agent_response: str, case_studies: str, connection_name: str) -> Dict[str, Any]:
-    """Call Snowflake Cortex LLM to judge the response."""
-    
-    prompt = JUDGE_PROMPT.format(
-        question=question,
-        agent_response=agent_response,
-        case_studies=case_studies
-    )
+def _cache_file(question: str, agent_response: str, case_studies: str) -> str:
+    """Path of the on-disk verdict for a set of judge inputs."""
+    key = hashlib.sha256(
+        "\x00".join([
+            JUDGE_MODEL, str(JUDGE_PROMPT_VERSION), question, agent_response, case_studies
+        ]).encode()
+    ).hexdigest()
+    return os.path.join(JUDGE_CACHE_DIR, f"{key}.json")
+
+
+def _read_cached(cache_file: str) -> Optional[Dict[str, Any]]:
+    """Load a cached verdict, or None on a cache miss or an unreadable cache file."""
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def _write_cached(cache_file: str, judgment: Dict[str, Any]) -> None:
+    """Store a verdict in the on-disk cache."""
+    # Only cache verdicts that parsed, so a bad LLM response is retried next time
+    if "error" in judgment:
+        return
+    os.makedirs(JUDGE_CACHE_DIR, exist_ok=True)
     
-    conn = snowflake.connector.connect(connection_name=connection_name)
-    cursor = conn.cursor()
+    # Write to a temp file and rename so an interrupted write never leaves a partial verdict
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(judgment, f, indent=2)
+    os.replace(tmp_file, cache_file)
+
+
+def _delta_blocks(session: Optional[Dict[str, Any]], blocks: List[str], block_hashes: List[str]) -> Optional[List[str]]:
+    """Return the case study blocks appended since the previous judgment, or None for a full evaluation.
     
-    # Use Cortex Complete for judgment
-    sql = """
-    SELECT SNOWFLAKE.CORTEX.COMPLETE(
-        'claude-3-5-sonnet',
-        %(prompt)s
-    ) AS judgment
+    A delta needs at least one new block; otherwise the judge would score the
+    response without seeing any case studies.
     """
+    if session is None:
+        return None
     
-    cursor.execute(sql, {"prompt": prompt})
-    result = cursor.fetchone()
+    previous = session["blocks"]
+    current = set(block_hashes)
+    if len(previous & current) / len(previous | current) < DELTA_OVERLAP_THRESHOLD:
+        return None
     
-    cursor.close()
-    conn.close()
+    # Blocks not seen before must form a suffix of the current list
+    first_new = next((i for i, h in enumerate(block_hashes) if h not in previous), len(block_hashes))
+    if first_new == len(block_hashes) or any(h in previous for h in block_hashes[first_new:]):
+        return None
     
-    # Parse JSON response
-    judgment_text = result[0]
+    return blocks[first_new:]
+
+
+def _get_conn(connection_name: str) -> snowflake.connector.SnowflakeConnection:
+    """Open one Snowflake session per connection name and reuse it across judgments."""
+    if connection_name not in _connections:
+        _connections[connection_name] = snowflake.connector.connect(connection_name=connection_name)
+    return _connections[connection_name]
+
+
+def _get_session(connection_name: str) -> "Session":
+    """Wrap the cached connection in a Snowpark session for the Cortex Python API."""
+    if connection_name not in _sessions:
+        from snowflake.snowpark import Session
+        
+        _sessions[connection_name] = Session.builder.configs(
+            {"connection": _get_conn(connection_name)}
+        ).create()
+    return _sessions[connection_name]
+
+
+def _close_cached(connection_name: str) -> None:
+    """Close the cached session and connection for connection_name, if any were opened."""
+    session = _sessions.pop(connection_name, None)
+    if session is not None:
+        session.close()
+    conn = _connections.pop(connection_name, None)
+    if conn is not None:
+        conn.close()
+
+
+def _complete(prompt: str, session: "Session") -> str:
+    """Run a prompt through Cortex Complete and return the raw text."""
+    from snowflake.cortex import Complete
+    
+    return Complete(JUDGE_MODEL, prompt, session=session)
+
+
+def _balanced_object_at(text: str, start: int) -> Optional[str]:
+    """Return the balanced {...} span starting at text[start], skipping braces inside strings."""
+    depth = 0
+    in_string = False
+    escape = False
     
-    # Try to extract JSON from the response
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+    
+    return None
+
+
+def _extract_json_object(text: str) -> Dict[str, Any]:
+    """Parse the first JSON object in text.
+    
+    Each "{" is tried in turn, so braces in prose before the verdict (e.g. a
+    quoted "{") do not hide the real object.
+    """
+    start = text.find("{")
+    while start >= 0:
+        candidate = _balanced_object_at(text, start)
+        if candidate is not None:
+            try:
+                return json.loads(candidate)
+            except json.JSONDecodeError:
+                pass
+        start = text.find("{", start + 1)
+    
+    raise ValueError("No complete JSON object found in response")
+
+
+def _parse_judgment(judgment_text: str) -> Dict[str, Any]:
+    """Parse the JSON verdict out of the LLM response."""
     try:
-        # Look for JSON block in markdown
-        if "```json" in judgment_text:
-            json_start = judgment_text.index("```json") + 7
-            json_end = judgment_text.index("```", json_start)
-            judgment_text = judgment_text[json_start:json_end]
-        elif "```" in judgment_text:
-            json_start = judgment_text.index("```") + 3
-            json_end = judgment_text.index("```", json_start)
-            judgment_text = judgment_text[json_start:json_end]
-        
-        return json.loads(judgment_text.strip())
-    except (ValueError, json.JSONDecodeError) as e:
+        return _extract_json_object(judgment_text)
+    except ValueError as e:
         print(f"Warning: Could not parse JSON from LLM response: {e}")
         print(f"Raw response: {judgment_text}")
         return {"error": "Failed to parse JSON", "raw_response": judgment_text}
 
 
-def main():
-    if len(sys.argv) < 4:
-        print("Usage: python llm_judge_cortex_search.py <response_file> <question> <output_file> [connection_name]")
-        sys.exit(1)
+def call_llm_judge(
+    question: str,
+    agent_response: str,
+    case_studies: str,
+    connection_name: str,
+    session: Optional["Session"] = None
+) -> Dict[str, Any]:
+    """Call Snowflake Cortex LLM to judge the response.
     
-    response_file = sys.argv[1]
-    question = sys.argv[2]
-    output_file = sys.argv[3]
-    connection_name = sys.argv[4] if len(sys.argv) > 4 else os.getenv("SNOWFLAKE_CONNECTION_NAME", "MY_DEMO")
+    Pass an open ``session`` to judge a batch over one session; otherwise a cached
+    session for ``connection_name`` is used.
     
-    # Load response data
-    with open(response_file, 'r') as f:
-        response_data = json.load(f)
+    Verdicts from full evaluations are cached on disk under their inputs.
     
-    # Extract components
-    agent_response = extract_agent_response(response_data)
-    case_studies = extract_case_studies_from_response(response_data)
+    When the same question was fully judged earlier in this process and the case
+    studies only gained blocks at the end, just the new blocks and the previous
+    verdict are sent. Such delta verdicts are neither cached on disk nor used as the
+    baseline for later deltas. Only callers that judge repeatedly in one process
+    (e.g. a regression loop) benefit: ``main`` makes a single call in file mode, and
+    directory mode uses call_llm_judge_batch, which always sends full prompts.
+    """
+    cache_file = _cache_file(question, agent_response, case_studies)
+    judgment = _read_cached(cache_file)
+    if judgment is not None:
+        return judgment
     
-    print(f"Evaluating response to: {question}")
-    print(f"Found {len(case_studies.split('---'))} case studies")
-    print("Calling LLM judge...")
+    question_key = hashlib.sha256(question.encode()).hexdigest()
+    blocks = case_studies.split(CASE_STUDY_SEPARATOR)
+    block_hashes = [hashlib.sha256(block.encode()).hexdigest() for block in blocks]
     
-    # Call judge
-    judgment = call_llm_judge(question, agent_response, case_studies, connection_name)
+    new_blocks = _delta_blocks(_judge_sessions.get(question_key), blocks, block_hashes)
+    if new_blocks is not None:
+        prompt = DELTA_PROMPT.format(
+            question=question,
+            agent_response=agent_response,
+            prior_verdict=json.dumps(_judge_sessions[question_key]["verdict"]),
+            new_case_studies=CASE_STUDY_SEPARATOR.join(new_blocks)
+        )
+    else:
+        prompt = build_prompt(question, agent_response, case_studies)
     
-    # Save results
+    if session is None:
+        session = _get_session(connection_name)
+    
+    judgment = _parse_judgment(_complete(prompt, session))
+    
+    # Only full evaluations become the cached verdict and the baseline for later deltas
+    if new_blocks is None and "error" not in judgment:
+        _write_cached(cache_file, judgment)
+        _judge_sessions[question_key] = {"blocks": set(block_hashes), "verdict": judgment}
+    
+    return judgment
+
+
+def call_llm_judge_batch(
+    triples: List[Tuple[str, str, str]],
+    connection_name: str,
+    conn: Optional[snowflake.connector.SnowflakeConnection] = None
+) -> List[Dict[str, Any]]:
+    """Judge several (question, agent_response, case_studies) triples in one Cortex call.
+    
+    Cached verdicts are reused; the remaining prompts are sent as rows of a single
+    VALUES table so Snowflake runs the completions server-side in one round trip.
+    """
+    cache_files = [_cache_file(*triple) for triple in triples]
+    judgments = [_read_cached(cache_file) for cache_file in cache_files]
+    pending = [i for i, judgment in enumerate(judgments) if judgment is None]
+    
+    if not pending:
+        return judgments
+    
+    if conn is None:
+        conn = _get_conn(connection_name)
+    
+    rows = ", ".join(f"({i}, %s)" for i in pending)
+    sql = f"""
+    SELECT t.idx, SNOWFLAKE.CORTEX.COMPLETE(%s, t.prompt) AS judgment
+    FROM VALUES {rows} AS t(idx, prompt)
+    ORDER BY t.idx
+    """
+    params = [JUDGE_MODEL]
+    for i in pending:
+        question, agent_response, case_studies = triples[i]
+        params.append(build_prompt(question, agent_response, case_studies))
+    
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    
+    for idx, judgment_text in rows:
+        judgments[idx] = _parse_judgment(judgment_text)
+        _write_cached(cache_files[idx], judgments[idx])
+    
+    return judgments
+
+
+def _load_response(response_file: str) -> Tuple[str, str, int]:
+    """Read a response file and return the agent response, case studies and case study count."""
+    with open(response_file, 'rb') as f:
+        response_data = orjson.loads(f.read())
+    
+    case_studies, num_case_studies = extract_case_studies_from_response(response_data)
+    return extract_agent_response(response_data), case_studies, num_case_studies
+
+
+def _load_questions(question_map: str) -> Dict[str, str]:
+    """Read a question map and return {response file name: question}."""
+    with open(question_map, 'rb') as f:
+        entries = orjson.loads(f.read())
+    
+    return {os.path.basename(entry["response_file"]): entry["question"] for entry in entries}
+
+
+def _save_judgment(
+    question: str,
+    response_file: str,
+    output_file: str,
+    agent_response: str,
+    num_case_studies: int,
+    judgment: Dict[str, Any]
+) -> None:
+    """Write a judgment file and print its scores."""
     output_data = {
         "question": question,
         "response_file": response_file,
         "judgment": judgment,
         "metadata": {
             "agent_response_length": len(agent_response),
-            "num_case_studies": len(case_studies.split('---'))
+            "num_case_studies": num_case_studies
         }
     }
     
-    with open(output_file, 'w') as f:
-        json.dump(output_data, f, indent=2)
+    with open(output_file, 'wb') as f:
+        f.write(orjson.dumps(output_data, option=orjson.OPT_INDENT_2))
     
     print(f"\n✅ Judgment saved to: {output_file}")
     print(f"\nOverall Score: {judgment.get('overall_score', 'N/A')}/5.0")
@@ -211,5 +496,69 @@ def main():
                 print(f"  {dimension.title()}: {score}/5")
 
 
+def main():
+    if len(sys.argv) < 4:
+        print("Usage: python llm_judge_cortex_search.py <response_file> <question> <output_file> [connection_name]")
+        print("       python llm_judge_cortex_search.py <response_dir> <question_map> <output_dir> [connection_name]")
+        sys.exit(1)
+    
+    response_file = sys.argv[1]
+    question = sys.argv[2]
+    output_file = sys.argv[3]
+    connection_name = sys.argv[4] if len(sys.argv) > 4 else os.getenv("SNOWFLAKE_CONNECTION_NAME", "MY_DEMO")
+    
+    if os.path.isdir(response_file):
+        questions_by_file = _load_questions(question)
+        response_files = []
+        for path in sorted(glob.glob(os.path.join(response_file, "*_response.json"))):
+            if os.path.basename(path) in questions_by_file:
+                response_files.append(path)
+            else:
+                print(f"Skipping {path}: no question for it in {question}")
+        
+        questions = [questions_by_file[os.path.basename(path)] for path in response_files]
+        responses = [_load_response(path) for path in response_files]
+        
+        print(f"Evaluating {len(response_files)} responses")
+        print("Calling LLM judge...")
+        
+        try:
+            judgments = call_llm_judge_batch(
+                [
+                    (file_question, agent_response, case_studies)
+                    for file_question, (agent_response, case_studies, _) in zip(questions, responses)
+                ],
+                connection_name
+            )
+        finally:
+            _close_cached(connection_name)
+        
+        os.makedirs(output_file, exist_ok=True)
+        for path, file_question, (agent_response, _, num_case_studies), judgment in zip(
+            response_files, questions, responses, judgments
+        ):
+            judgment_file = os.path.join(
+                output_file, os.path.basename(path).replace("_response.json", "_judgment.json")
+            )
+            _save_judgment(file_question, path, judgment_file, agent_response, num_case_studies, judgment)
+        return
+    
+    # Extract components
+    agent_response, case_studies, num_case_studies = _load_response(response_file)
+    
+    print(f"Evaluating response to: {question}")
+    print(f"Found {num_case_studies} case studies")
+    print("Calling LLM judge...")
+    
+    # Call judge (the session is only opened on a cache miss)
+    try:
+        judgment = call_llm_judge(question, agent_response, case_studies, connection_name)
+    finally:
+        _close_cached(connection_name)
+    
+    # Save results
+    _save_judgment(question, response_file, output_file, agent_response, num_case_studies, judgment)
+
+
 if __name__ == "__main__":
     main()
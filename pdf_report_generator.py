@@ -7,157 +7,258 @@ Uses ReportLab for PDF generation and matplotlib for charts.
 
 import io
 import os
+import time
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Optional, Tuple
 
 import matplotlib
 matplotlib.use('Agg')  # Use non-interactive backend
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 from matplotlib.patches import Rectangle
+import numpy as np
+import pandas as pd
 import snowflake.connector
 
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter, A4
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle, StyleSheet1
 from reportlab.lib.units import inch
 from reportlab.platypus import (
-    SimpleDocTemplate, Paragraph, Spacer, PageBreak, Image,
+    BaseDocTemplate, Frame, PageTemplate, Paragraph, Spacer, PageBreak, Image,
     Table, TableStyle, KeepTogether
 )
 from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT, TA_JUSTIFY
 
 
+def _build_styles() -> StyleSheet1:
+    """Build the report stylesheet with the custom paragraph styles."""
+    styles = getSampleStyleSheet()
+    
+    # Title style
+    styles.add(ParagraphStyle(
+        name='CustomTitle',
+        parent=styles['Heading1'],
+        fontSize=24,
+        textColor=colors.HexColor('#1E3A8A'),
+        spaceAfter=30,
+        alignment=TA_CENTER
+    ))
+    
+    # Section heading style
+    styles.add(ParagraphStyle(
+        name='SectionHeading',
+        parent=styles['Heading2'],
+        fontSize=16,
+        textColor=colors.HexColor('#1E3A8A'),
+        spaceBefore=20,
+        spaceAfter=12,
+        borderWidth=0,
+        borderPadding=5,
+        borderColor=colors.HexColor('#3B82F6'),
+        backColor=colors.HexColor('#EFF6FF')
+    ))
+    
+    # Body text style (the sample sheet already defines BodyText, so adjust it in place)
+    body_text = styles['BodyText']
+    body_text.fontSize = 11
+    body_text.leading = 14
+    body_text.alignment = TA_JUSTIFY
+    body_text.spaceBefore = 0
+    body_text.spaceAfter = 10
+    
+    # Metric style (for highlighting key numbers)
+    styles.add(ParagraphStyle(
+        name='MetricText',
+        parent=styles['Normal'],
+        fontSize=12,
+        textColor=colors.HexColor('#059669'),
+        fontName='Helvetica-Bold'
+    ))
+    
+    return styles
+
+
+# Connection used when none is passed explicitly
+_DEFAULT_CONN = os.getenv("SNOWFLAKE_CONNECTION_NAME", "MY_DEMO")
+
+# Upper bound on points drawn in the conversion trend chart
+_MAX_TREND_POINTS = 60
+
+# Metric queries, parameterized by (customer_id, days)
+
+# Daily conversion metrics
+_SQL_CONVERSIONS = """
+    SELECT 
+        DATE_TRUNC('day', conversion_date) as date,
+        COUNT(*) as conversion_count,
+        SUM(conversion_value) as total_revenue,
+        AVG(conversion_value) as avg_conversion_value
+    FROM CUSTOMER_SUCCESS_DATA.ANALYTICS.conversions
+    WHERE customer_id = %s
+      AND conversion_date >= DATEADD(day, -%s, CURRENT_DATE())
+    GROUP BY 1
+    ORDER BY 1
+"""
+
+# Engagement metrics by channel
+_SQL_ENGAGEMENT = """
+    SELECT 
+        channel,
+        SUM(messages_sent) as total_sent,
+        SUM(messages_opened) as total_opened,
+        SUM(messages_clicked) as total_clicked,
+        AVG(engagement_score) as avg_engagement_score
+    FROM CUSTOMER_SUCCESS_DATA.ANALYTICS.historical_engagement
+    WHERE customer_id = %s
+      AND engagement_date >= DATEADD(day, -%s, CURRENT_DATE())
+    GROUP BY 1
+    ORDER BY 2 DESC
+"""
+
+# Attribution by channel
+_SQL_ATTRIBUTION = """
+    SELECT 
+        channel,
+        COUNT(*) as touchpoint_count,
+        SUM(attributed_revenue) as total_attributed_revenue,
+        AVG(attribution_weight) as avg_attribution_weight
+    FROM CUSTOMER_SUCCESS_DATA.ANALYTICS.attributions
+    WHERE customer_id = %s
+      AND touchpoint_date >= DATEADD(day, -%s, CURRENT_DATE())
+    GROUP BY 1
+    ORDER BY 3 DESC
+"""
+
+# Conversion totals for the summary table
+_SQL_CONVERSION_TOTALS = """
+    SELECT 
+        COUNT(*) as total_conversions,
+        COALESCE(SUM(conversion_value), 0) as total_revenue
+    FROM CUSTOMER_SUCCESS_DATA.ANALYTICS.conversions
+    WHERE customer_id = %s
+      AND conversion_date >= DATEADD(day, -%s, CURRENT_DATE())
+"""
+
+# Engagement totals for the summary table
+_SQL_ENGAGEMENT_TOTALS = """
+    SELECT 
+        COALESCE(SUM(messages_sent), 0) as total_sent,
+        COALESCE(SUM(messages_opened), 0) as total_opened
+    FROM CUSTOMER_SUCCESS_DATA.ANALYTICS.historical_engagement
+    WHERE customer_id = %s
+      AND engagement_date >= DATEADD(day, -%s, CURRENT_DATE())
+"""
+
+# Styles are shared by every generator instance
+_STYLES = _build_styles()
+
+# Page layout shared by every report: letter pages with 0.75 inch margins
+_PAGE_MARGIN = 0.75*inch
+_PAGE_TEMPLATE = PageTemplate(
+    id='Report',
+    frames=[Frame(
+        _PAGE_MARGIN,
+        _PAGE_MARGIN,
+        letter[0] - 2*_PAGE_MARGIN,
+        letter[1] - 2*_PAGE_MARGIN,
+        id='normal'
+    )],
+    pagesize=letter
+)
+
+
 class PDFReportGenerator:
     """Generates PDF reports with charts from weekly report data."""
     
-    def __init__(self, connection_name: str = "MY_DEMO"):
+    def __init__(self, connection_name: str = _DEFAULT_CONN):
         """Initialize the PDF report generator with Snowflake connection."""
-        self.conn = snowflake.connector.connect(
-            connection_name=os.getenv("SNOWFLAKE_CONNECTION_NAME") or connection_name
-        )
-        self.styles = getSampleStyleSheet()
-        self._setup_custom_styles()
-        
-    def _setup_custom_styles(self):
-        """Define custom paragraph styles for the report."""
-        # Title style
-        self.styles.add(ParagraphStyle(
-            name='CustomTitle',
-            parent=self.styles['Heading1'],
-            fontSize=24,
-            textColor=colors.HexColor('#1E3A8A'),
-            spaceAfter=30,
-            alignment=TA_CENTER
-        ))
+        self.conn = snowflake.connector.connect(connection_name=connection_name)
+        self.styles = _STYLES
+        # One figure is cleared and redrawn for every chart
+        self._fig = plt.figure(figsize=(10, 5))
         
-        # Section heading style
-        self.styles.add(ParagraphStyle(
-            name='SectionHeading',
-            parent=self.styles['Heading2'],
-            fontSize=16,
-            textColor=colors.HexColor('#1E3A8A'),
-            spaceBefore=20,
-            spaceAfter=12,
-            borderWidth=0,
-            borderPadding=5,
-            borderColor=colors.HexColor('#3B82F6'),
-            backColor=colors.HexColor('#EFF6FF')
-        ))
+    def get_customer_metrics(self, customer_id: str, days: int = 30) -> Dict:
+        """Fetch customer metrics from the database.
         
-        # Body text style
-        self.styles.add(ParagraphStyle(
-            name='BodyText',
-            parent=self.styles['Normal'],
-            fontSize=11,
-            leading=14,
-            alignment=TA_JUSTIFY,
-            spaceAfter=10
-        ))
+        The queries are submitted asynchronously so they run concurrently, and
+        results are fetched as pandas DataFrames over Arrow.
+        """
+        params = (customer_id, days)
+        conversion_cursor = self.conn.cursor()
+        engagement_cursor = self.conn.cursor()
+        attribution_cursor = self.conn.cursor()
+        conversion_totals_cursor = self.conn.cursor()
+        engagement_totals_cursor = self.conn.cursor()
+        
+        cursors = (
+            conversion_cursor, engagement_cursor, attribution_cursor,
+            conversion_totals_cursor, engagement_totals_cursor
+        )
         
-        # Metric style (for highlighting key numbers)
-        self.styles.add(ParagraphStyle(
-            name='MetricText',
-            parent=self.styles['Normal'],
-            fontSize=12,
-            textColor=colors.HexColor('#059669'),
-            fontName='Helvetica-Bold'
-        ))
+        try:
+            conversion_cursor.execute_async(_SQL_CONVERSIONS, params)
+            engagement_cursor.execute_async(_SQL_ENGAGEMENT, params)
+            attribution_cursor.execute_async(_SQL_ATTRIBUTION, params)
+            conversion_totals_cursor.execute_async(_SQL_CONVERSION_TOTALS, params)
+            engagement_totals_cursor.execute_async(_SQL_ENGAGEMENT_TOTALS, params)
+            
+            for cursor in cursors:
+                self._wait_for_results(cursor)
+            
+            metrics = {
+                'conversion_data': conversion_cursor.fetch_pandas_all(),
+                'engagement_by_channel': engagement_cursor.fetch_pandas_all(),
+                'attribution_data': attribution_cursor.fetch_pandas_all(),
+                'conversion_totals': conversion_totals_cursor.fetch_pandas_all().iloc[0],
+                'engagement_totals': engagement_totals_cursor.fetch_pandas_all().iloc[0]
+            }
+        except Exception:
+            self._cancel_running(cursors)
+            raise
+        finally:
+            for cursor in cursors:
+                cursor.close()
+        
+        return metrics
     
-    def get_customer_metrics(self, customer_id: str, days: int = 30) -> Dict:
-        """Fetch customer metrics from the database."""
-        cursor = self.conn.cursor()
-        
-        # Get conversion metrics
-        cursor.execute("""
-            SELECT 
-                DATE_TRUNC('day', conversion_date) as date,
-                COUNT(*) as conversion_count,
-                SUM(conversion_value) as total_revenue,
-                AVG(conversion_value) as avg_conversion_value
-            FROM CUSTOMER_SUCCESS_DATA.ANALYTICS.conversions
-            WHERE customer_id = %s
-              AND conversion_date >= DATEADD(day, -%s, CURRENT_DATE())
-            GROUP BY 1
-            ORDER BY 1
-        """, (customer_id, days))
-        
-        conversion_data = cursor.fetchall()
-        
-        # Get engagement metrics by channel
-        cursor.execute("""
-            SELECT 
-                channel,
-                SUM(messages_sent) as total_sent,
-                SUM(messages_opened) as total_opened,
-                SUM(messages_clicked) as total_clicked,
-                AVG(engagement_score) as avg_engagement_score
-            FROM CUSTOMER_SUCCESS_DATA.ANALYTICS.historical_engagement
-            WHERE customer_id = %s
-              AND engagement_date >= DATEADD(day, -%s, CURRENT_DATE())
-            GROUP BY 1
-            ORDER BY 2 DESC
-        """, (customer_id, days))
-        
-        engagement_by_channel = cursor.fetchall()
-        
-        # Get attribution by channel
-        cursor.execute("""
-            SELECT 
-                channel,
-                COUNT(*) as touchpoint_count,
-                SUM(attributed_revenue) as total_attributed_revenue,
-                AVG(attribution_weight) as avg_attribution_weight
-            FROM CUSTOMER_SUCCESS_DATA.ANALYTICS.attributions
-            WHERE customer_id = %s
-              AND touchpoint_date >= DATEADD(day, -%s, CURRENT_DATE())
-            GROUP BY 1
-            ORDER BY 3 DESC
-        """, (customer_id, days))
-        
-        attribution_data = cursor.fetchall()
-        
-        cursor.close()
-        
-        return {
-            'conversion_data': conversion_data,
-            'engagement_by_channel': engagement_by_channel,
-            'attribution_data': attribution_data
-        }
+    def _cancel_running(self, cursors) -> None:
+        """Cancel any async queries from cursors that are still running."""
+        for cursor in cursors:
+            if not cursor.sfqid:
+                continue
+            try:
+                if self.conn.is_still_running(self.conn.get_query_status(cursor.sfqid)):
+                    cancel_cursor = self.conn.cursor()
+                    cancel_cursor.execute("SELECT SYSTEM$CANCEL_QUERY(%s)", (cursor.sfqid,))
+                    cancel_cursor.close()
+            except Exception as e:
+                print(f"⚠ Could not cancel query {cursor.sfqid}: {e}")
+    
+    def _wait_for_results(self, cursor) -> None:
+        """Block until an async query finishes, then load its results into the cursor."""
+        while self.conn.is_still_running(self.conn.get_query_status_throw_if_error(cursor.sfqid)):
+            time.sleep(0.05)
+        cursor.get_results_from_sfqid(cursor.sfqid)
     
-    def create_conversion_trend_chart(self, conversion_data: List, customer_id: str) -> str:
+    def create_conversion_trend_chart(self, conversion_data: pd.DataFrame, customer_id: str) -> Optional[io.BytesIO]:
         """Create a line chart showing conversion trends over time."""
-        if not conversion_data:
+        if conversion_data.empty:
             return None
             
-        fig, ax = plt.subplots(figsize=(10, 5))
+        self._fig.clf()
         
-        dates = [row[0] for row in conversion_data]
-        revenues = [float(row[2]) if row[2] else 0 for row in conversion_data]
-        counts = [int(row[1]) if row[1] else 0 for row in conversion_data]
+        # Decimate long date ranges so drawing cost stays bounded
+        if len(conversion_data) > _MAX_TREND_POINTS:
+            step = -(-len(conversion_data) // _MAX_TREND_POINTS)
+            conversion_data = conversion_data.iloc[::step]
+        
+        dates = conversion_data['DATE']
+        revenues = conversion_data['TOTAL_REVENUE'].to_numpy(dtype=float, na_value=0)
+        counts = conversion_data['CONVERSION_COUNT'].to_numpy(dtype=int, na_value=0)
         
         # Create dual axis
-        ax1 = ax
+        ax1 = self._fig.add_subplot(111)
         ax2 = ax1.twinx()
         
         # Plot revenue
@@ -176,44 +277,32 @@ class PDFReportGenerator:
         ax1.xaxis.set_major_formatter(mdates.DateFormatter('%m/%d'))
         plt.setp(ax1.xaxis.get_majorticklabels(), rotation=45)
         
-        plt.title(f'Conversion Trends - {customer_id}', fontsize=14, fontweight='bold')
+        ax1.set_title(f'Conversion Trends - {customer_id}', fontsize=14, fontweight='bold')
         
         # Add legends
         lines1, labels1 = ax1.get_legend_handles_labels()
         lines2, labels2 = ax2.get_legend_handles_labels()
         ax1.legend(lines1 + lines2, labels1 + labels2, loc='upper left')
         
-        plt.tight_layout()
-        
-        # Save to bytes
-        img_buffer = io.BytesIO()
-        plt.savefig(img_buffer, format='png', dpi=150, bbox_inches='tight')
-        img_buffer.seek(0)
-        plt.close()
-        
-        # Save to temp file
-        temp_file = f'/tmp/conversion_trend_{customer_id}.png'
-        with open(temp_file, 'wb') as f:
-            f.write(img_buffer.getvalue())
+        self._fig.tight_layout()
         
-        return temp_file
+        return self._render_png()
     
-    def create_channel_performance_chart(self, engagement_data: List, customer_id: str) -> str:
+    def create_channel_performance_chart(self, engagement_data: pd.DataFrame, customer_id: str) -> Optional[io.BytesIO]:
         """Create a bar chart showing channel performance metrics."""
-        if not engagement_data:
+        if engagement_data.empty:
             return None
             
-        fig, ax = plt.subplots(figsize=(10, 5))
+        self._fig.clf()
+        ax = self._fig.add_subplot(111)
         
-        channels = [row[0] for row in engagement_data]
-        open_rates = [
-            (float(row[2]) / float(row[1]) * 100) if row[1] and row[1] > 0 else 0 
-            for row in engagement_data
-        ]
-        ctr = [
-            (float(row[3]) / float(row[2]) * 100) if row[2] and row[2] > 0 else 0 
-            for row in engagement_data
-        ]
+        channels = engagement_data['CHANNEL'].tolist()
+        sent = engagement_data['TOTAL_SENT'].to_numpy(dtype=float, na_value=0)
+        opened = engagement_data['TOTAL_OPENED'].to_numpy(dtype=float, na_value=0)
+        clicked = engagement_data['TOTAL_CLICKED'].to_numpy(dtype=float, na_value=0)
+        # Rates are 0 where the denominator is 0
+        open_rates = np.divide(opened, sent, out=np.zeros_like(sent), where=sent > 0) * 100
+        ctr = np.divide(clicked, opened, out=np.zeros_like(opened), where=opened > 0) * 100
         
         x = range(len(channels))
         width = 0.35
@@ -229,24 +318,20 @@ class PDFReportGenerator:
         ax.legend()
         ax.grid(True, axis='y', alpha=0.3)
         
-        plt.tight_layout()
-        
-        # Save to temp file
-        temp_file = f'/tmp/channel_performance_{customer_id}.png'
-        plt.savefig(temp_file, format='png', dpi=150, bbox_inches='tight')
-        plt.close()
+        self._fig.tight_layout()
         
-        return temp_file
+        return self._render_png()
     
-    def create_attribution_chart(self, attribution_data: List, customer_id: str) -> str:
+    def create_attribution_chart(self, attribution_data: pd.DataFrame, customer_id: str) -> Optional[io.BytesIO]:
         """Create a horizontal bar chart showing attribution by channel."""
-        if not attribution_data:
+        if attribution_data.empty:
             return None
             
-        fig, ax = plt.subplots(figsize=(10, 5))
+        self._fig.clf()
+        ax = self._fig.add_subplot(111)
         
-        channels = [row[0] for row in attribution_data]
-        revenues = [float(row[2]) if row[2] else 0 for row in attribution_data]
+        channels = attribution_data['CHANNEL'].tolist()
+        revenues = attribution_data['TOTAL_ATTRIBUTED_REVENUE'].to_numpy(dtype=float, na_value=0)
         
         colors_map = ['#3B82F6', '#10B981', '#F59E0B', '#EF4444', '#8B5CF6']
         bar_colors = [colors_map[i % len(colors_map)] for i in range(len(channels))]
@@ -262,27 +347,29 @@ class PDFReportGenerator:
         
         # Add value labels
         for i, v in enumerate(revenues):
-            ax.text(v + max(revenues) * 0.01, i, f'${v:,.0f}', 
+            ax.text(v + revenues.max() * 0.01, i, f'${v:,.0f}', 
                    va='center', fontsize=10)
         
-        plt.tight_layout()
+        self._fig.tight_layout()
         
-        # Save to temp file
-        temp_file = f'/tmp/attribution_{customer_id}.png'
-        plt.savefig(temp_file, format='png', dpi=150, bbox_inches='tight')
-        plt.close()
-        
-        return temp_file
+        return self._render_png()
+    
+    def _render_png(self) -> io.BytesIO:
+        """Render the current figure to an in-memory PNG."""
+        buf = io.BytesIO()
+        self._fig.savefig(buf, format='png', dpi=150, bbox_inches='tight')
+        buf.seek(0)
+        return buf
     
     def create_metrics_summary_table(self, metrics: Dict) -> Table:
         """Create a summary table of key metrics."""
-        # Calculate summary metrics
-        total_conversions = sum(row[1] for row in metrics['conversion_data'] if row[1])
-        total_revenue = sum(row[2] for row in metrics['conversion_data'] if row[2])
+        # Summary metrics are aggregated in Snowflake
+        total_conversions = int(metrics['conversion_totals']['TOTAL_CONVERSIONS'])
+        total_revenue = float(metrics['conversion_totals']['TOTAL_REVENUE'])
         avg_conv_value = total_revenue / total_conversions if total_conversions > 0 else 0
         
-        total_sent = sum(row[1] for row in metrics['engagement_by_channel'] if row[1])
-        total_opened = sum(row[2] for row in metrics['engagement_by_channel'] if row[2])
+        total_sent = int(metrics['engagement_totals']['TOTAL_SENT'])
+        total_opened = int(metrics['engagement_totals']['TOTAL_OPENED'])
         overall_open_rate = (total_opened / total_sent * 100) if total_sent > 0 else 0
         
         data = [
@@ -324,14 +411,15 @@ class PDFReportGenerator:
         
         print(f"Generating PDF report for {customer_id}...")
         
-        # Create document
-        doc = SimpleDocTemplate(
+        # Create document from the prebuilt page template
+        doc = BaseDocTemplate(
             output_path,
             pagesize=letter,
-            rightMargin=0.75*inch,
-            leftMargin=0.75*inch,
-            topMargin=0.75*inch,
-            bottomMargin=0.75*inch
+            rightMargin=_PAGE_MARGIN,
+            leftMargin=_PAGE_MARGIN,
+            topMargin=_PAGE_MARGIN,
+            bottomMargin=_PAGE_MARGIN,
+            pageTemplates=[_PAGE_TEMPLATE]
         )
         
         story = []
@@ -379,10 +467,10 @@ class PDFReportGenerator:
                 story.append(Spacer(1, 0.1*inch))
         
         # Add conversion trend chart
-        chart_file = self.create_conversion_trend_chart(metrics['conversion_data'], customer_id)
-        if chart_file:
+        chart_buf = self.create_conversion_trend_chart(metrics['conversion_data'], customer_id)
+        if chart_buf:
             story.append(Spacer(1, 0.2*inch))
-            img = Image(chart_file, width=6.5*inch, height=3.25*inch)
+            img = Image(chart_buf, width=6.5*inch, height=3.25*inch)
             story.append(img)
             story.append(Spacer(1, 0.2*inch))
         
@@ -399,18 +487,18 @@ class PDFReportGenerator:
                 story.append(Spacer(1, 0.1*inch))
         
         # Add channel performance chart
-        chart_file = self.create_channel_performance_chart(metrics['engagement_by_channel'], customer_id)
-        if chart_file:
+        chart_buf = self.create_channel_performance_chart(metrics['engagement_by_channel'], customer_id)
+        if chart_buf:
             story.append(Spacer(1, 0.2*inch))
-            img = Image(chart_file, width=6.5*inch, height=3.25*inch)
+            img = Image(chart_buf, width=6.5*inch, height=3.25*inch)
             story.append(img)
             story.append(Spacer(1, 0.2*inch))
         
         # Add attribution chart
-        chart_file = self.create_attribution_chart(metrics['attribution_data'], customer_id)
-        if chart_file:
+        chart_buf = self.create_attribution_chart(metrics['attribution_data'], customer_id)
+        if chart_buf:
             story.append(Spacer(1, 0.2*inch))
-            img = Image(chart_file, width=6.5*inch, height=3.25*inch)
+            img = Image(chart_buf, width=6.5*inch, height=3.25*inch)
             story.append(img)
         
         story.append(PageBreak())
@@ -433,7 +521,8 @@ class PDFReportGenerator:
         return output_path
     
     def close(self):
-        """Close the Snowflake connection."""
+        """Close the Snowflake connection and release the chart figure."""
+        plt.close(self._fig)
         self.conn.close()
 
 
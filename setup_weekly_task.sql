@@ -211,6 +211,23 @@ AS
 -- To enable the task (commented out by default):
 -- ALTER TASK weekly_report_generation_task RESUME;
 
+-- Cache of Cortex Agent section responses used by weekly_report_generator.py
+CREATE TABLE IF NOT EXISTS cortex_agent_cache (
+    key_hash VARCHAR PRIMARY KEY,
+    response_json VARIANT,
+    created_at TIMESTAMP_NTZ DEFAULT CURRENT_TIMESTAMP()
+);
+
+-- Delete expired cache entries daily (keep in sync with AGENT_CACHE_TTL_DAYS)
+CREATE OR REPLACE TASK cortex_agent_cache_cleanup_task
+    WAREHOUSE = COMPUTE_WH
+    SCHEDULE = 'USING CRON 0 6 * * * America/Los_Angeles'
+AS
+    DELETE FROM cortex_agent_cache
+    WHERE created_at < DATEADD(day, -1, CURRENT_TIMESTAMP());
+
+-- ALTER TASK cortex_agent_cache_cleanup_task RESUME;
+
 -- To manually run the task for testing:
 -- EXECUTE TASK weekly_report_generation_task;
 
@@ -5,55 +5,272 @@ This script generates weekly executive review reports for customer success manag
 by calling the Cortex Agent API to analyze customer data and create structured reports.
 """
 
+import asyncio
+import hashlib
+import logging
 import os
-import json
-import requests
+import httpx
+import ijson
+import orjson
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import snowflake.connector
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of customer reports generated at the same time
+MAX_CONCURRENT_REPORTS = 8
+
+# Fail fast on unreachable hosts; a stalled agent run is abandoned after 120s without data
+AGENT_TIMEOUT = httpx.Timeout(120.0, connect=5.0)
+
+# Agent calls are retried with exponential backoff on connect errors and these statuses
+AGENT_RETRIES = 3
+AGENT_RETRY_BACKOFF = 0.5
+AGENT_RETRY_STATUSES = {502, 503, 504}
+
+# Agent responses larger than this are rejected instead of being read to the end
+MAX_AGENT_RESPONSE_BYTES = 10 * 1024 * 1024
+
+# Reports are written with one INSERT per batch of this many rows
+INSERT_BATCH_SIZE = 50
+
+# Agent responses are cached per customer, report period and section in this table
+# (created by setup_weekly_task.sql). The period is the 7 days ending today, so entries
+# only match re-runs on the same day; keep the TTL in sync with the cleanup task there.
+AGENT_CACHE_TABLE = "CUSTOMER_SUCCESS_DATA.ANALYTICS.CORTEX_AGENT_CACHE"
+AGENT_CACHE_TTL_DAYS = 1
+
+# Bump when the section prompts change so older cached responses are not reused
+PROMPT_VERSION = 2
+
+# Connections are kept open between agent calls so TLS handshakes are not repeated
+AGENT_POOL_LIMITS = httpx.Limits(
+    max_connections=32,
+    max_keepalive_connections=32,
+    keepalive_expiry=60.0
+)
+
+# Section prompts, filled in per customer with customer_id and the report period (ws, we)
+_PROMPT_TEMPLATES = {
+    'performance': """Customer {customer_id}, {ws} to {we}: performance vs industry benchmarks.
+- Conversions: revenue, count, average value
+- Engagement: open rate, CTR, engagement score
+- Benchmark and year-over-year comparison where data exists
+Be concise; lead with the key metrics.""",
+    
+    'business_value': """Customer {customer_id}, {ws} to {we}: business value analysis.
+- Revenue trends and growth
+- Engagement health
+- Channels driving the most value
+- Touchpoints contributing most to conversions
+State findings as business impact.""",
+    
+    'recommendations': """Customer {customer_id}, {ws} to {we}: 3-5 actionable recommendations from its data and Media & Entertainment case studies.
+For each: the action, supporting data or case study, expected impact.
+Focus: channel optimization, engagement, churn prevention."""
+}
+
+# Layout of the full text report; format_full_report fills in the header fields and sections
+_REPORT_SHELL = """
+================================================================================
+WEEKLY EXECUTIVE REVIEW REPORT
+================================================================================
+
+Customer ID: {customer_id}
+CSM: {csm_name}
+Report Period: {week_start} - {week_end}
+Generated: {generated}
+
+================================================================================
+1. PERFORMANCE VS BENCHMARKS
+================================================================================
+
+{performance}
+
+================================================================================
+2. BUSINESS VALUE ANALYSIS
+================================================================================
+
+{business_value}
+
+================================================================================
+3. RECOMMENDATIONS & BEST PRACTICES
+================================================================================
+
+{recommendations}
+
+================================================================================
+END OF REPORT
+================================================================================
+"""
 
 
 class WeeklyReportGenerator:
     """Generates weekly executive reports using Cortex Agent."""
     
-    def __init__(self, connection_name: str = "MY_DEMO"):
+    # Account URLs by account identifier, looked up once per process
+    _account_urls: Dict[str, str] = {}
+    
+    def __init__(self, connection_name: str = "MY_DEMO", use_cache: bool = True):
         """Initialize the report generator with Snowflake connection."""
         self.conn = snowflake.connector.connect(
             connection_name=os.getenv("SNOWFLAKE_CONNECTION_NAME") or connection_name
         )
+        self._cur = None
         self.account_url = self._get_account_url()
         self.token = self.conn.rest.token
-        
+        self._headers = {
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'Authorization': f'Snowflake Token="{self.token}"'
+        }
+        self._client: Optional[httpx.AsyncClient] = None
+        self.use_cache = use_cache
+        self._cached_responses: Dict[str, Dict] = {}
+        self._pending_cache_rows: Dict[str, str] = {}
+        self._pending_rows: List[tuple] = []
+        self.saved_report_count = 0
+        self._csm_names: Dict[str, str] = {}
+        self._shared_threads: Dict[str, asyncio.Task] = {}
+        
+    def _cursor(self):
+        """Return the generator's shared cursor, creating it on first use."""
+        if self._cur is None:
+            self._cur = self.conn.cursor()
+        return self._cur
+    
     def _get_account_url(self) -> str:
         """Get the Snowflake account URL for API calls."""
-        cursor = self.conn.cursor()
+        account = self.conn.account
+        if account in self._account_urls:
+            return self._account_urls[account]
+        
+        cursor = self._cursor()
         cursor.execute("SELECT CURRENT_ACCOUNT_URL()")
         account_url = cursor.fetchone()[0]
-        cursor.close()
         
         # Format: https://account.region.snowflakecomputing.com
         if not account_url.startswith('http'):
             account_url = f"https://{account_url}"
+        
+        self._account_urls[account] = account_url
         return account_url
     
-    def create_thread(self, origin_app: str = "weekly_report_generator") -> str:
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """HTTP client shared by all agent calls in the current event loop."""
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                headers=self._headers,
+                timeout=AGENT_TIMEOUT,
+                transport=httpx.AsyncHTTPTransport(
+                    http2=True,
+                    limits=AGENT_POOL_LIMITS,
+                    retries=AGENT_RETRIES
+                )
+            )
+        return self._client
+    
+    async def aclose_client(self):
+        """Close the HTTP client so the next run starts a fresh one."""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+    
+    def _cache_key(self, customer_id: str, week_start: datetime, week_end: datetime, section_name: str) -> str:
+        """Hash identifying one section of one customer's report for a period."""
+        return hashlib.sha256(
+            f"{customer_id}|{week_start.date()}|{week_end.date()}|{section_name}|{PROMPT_VERSION}".encode()
+        ).hexdigest()
+    
+    def _prefetch_cached(self, keys: List[str]):
+        """Load cached agent responses for keys in one query, before any agent calls start.
+        
+        Cache errors (e.g. the table is missing) are logged and treated as misses.
+        """
+        if not self.use_cache or not keys:
+            return
+        
+        placeholders = ", ".join(["%s"] * len(keys))
+        try:
+            cursor = self._cursor()
+            cursor.execute(f"""
+                SELECT key_hash, response_json
+                FROM {AGENT_CACHE_TABLE}
+                WHERE key_hash IN ({placeholders})
+                  AND created_at >= DATEADD(day, -%s, CURRENT_TIMESTAMP())
+            """, (*keys, AGENT_CACHE_TTL_DAYS))
+            rows = cursor.fetchall()
+        except Exception as e:
+            logger.warning("  ⚠ Agent response cache unavailable, calling the agent: %s", e)
+            return
+        
+        # VARIANT values come back as JSON text
+        for key, response_json in rows:
+            self._cached_responses[key] = orjson.loads(response_json)
+        logger.info("Loaded %d cached agent responses", len(rows))
+    
+    def _flush_cache(self):
+        """Store newly generated agent responses, replacing older entries for the same keys.
+        
+        A failed write only means the responses are not cached; it never fails a report.
+        """
+        if not self._pending_cache_rows:
+            return
+        
+        items = list(self._pending_cache_rows.items())
+        self._pending_cache_rows = {}
+        
+        try:
+            cursor = self._cursor()
+            for i in range(0, len(items), INSERT_BATCH_SIZE):
+                batch = items[i:i + INSERT_BATCH_SIZE]
+                rows = ", ".join(["(%s, %s)"] * len(batch))
+                cursor.execute(f"""
+                    MERGE INTO {AGENT_CACHE_TABLE} t
+                    USING (
+                        SELECT column1 AS key_hash, PARSE_JSON(column2) AS response_json
+                        FROM VALUES {rows}
+                    ) s
+                    ON t.key_hash = s.key_hash
+                    WHEN MATCHED THEN UPDATE SET
+                        response_json = s.response_json,
+                        created_at = CURRENT_TIMESTAMP()
+                    WHEN NOT MATCHED THEN INSERT (key_hash, response_json, created_at)
+                        VALUES (s.key_hash, s.response_json, CURRENT_TIMESTAMP())
+                """, [value for item in batch for value in item])
+            self.conn.commit()
+        except Exception as e:
+            logger.warning("  ⚠ Could not write agent response cache: %s", e)
+    
+    async def create_thread(self, origin_app: str = "weekly_report_generator") -> str:
         """Create a new thread for agent conversation."""
         url = f"{self.account_url}/api/v2/cortex/threads"
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'Authorization': f'Snowflake Token="{self.token}"'
-        }
         payload = {
             "origin_application": origin_app
         }
         
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
+        response = await self._post(url, payload)
+        try:
+            response.raise_for_status()
+            return orjson.loads(await response.aread())['thread_id']
+        finally:
+            await response.aclose()
+    
+    async def _shared_thread(self, thread_key: str) -> str:
+        """Return the thread shared under thread_key, creating it on first use.
         
-        return response.json()['thread_id']
+        Concurrent callers with the same key wait for the same create_thread call.
+        """
+        task = self._shared_threads.get(thread_key)
+        if task is None:
+            task = asyncio.ensure_future(self.create_thread())
+            self._shared_threads[thread_key] = task
+        return await task
     
-    def call_agent(
+    async def call_agent(
         self, 
         thread_id: str, 
         parent_message_id: str,
@@ -64,11 +281,6 @@ class WeeklyReportGenerator:
     ) -> Dict:
         """Call the Cortex Agent with a user message."""
         url = f"{self.account_url}/api/v2/databases/{database}/schemas/{schema}/agents/{agent_name}:run"
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'Authorization': f'Snowflake Token="{self.token}"'
-        }
         payload = {
             "thread_id": thread_id,
             "parent_message_id": parent_message_id,
@@ -85,95 +297,216 @@ class WeeklyReportGenerator:
             ]
         }
         
-        response = requests.post(url, headers=headers, json=payload)
-        response.raise_for_status()
+        response = await self._post(url, payload)
+        try:
+            response.raise_for_status()
+            return await self._parse_agent_stream(response)
+        finally:
+            await response.aclose()
+    
+    async def _post(self, url: str, payload: Dict) -> httpx.Response:
+        """POST a JSON payload and return the streaming response.
+        
+        Gateway errors (AGENT_RETRY_STATUSES) are retried up to AGENT_RETRIES times
+        with exponential backoff; the transport retries failed connects itself.
+        The caller must close the returned response.
+        """
+        body = orjson.dumps(payload)
         
-        return response.json()
+        for attempt in range(AGENT_RETRIES + 1):
+            request = self.client.build_request("POST", url, content=body)
+            response = await self.client.send(request, stream=True)
+            
+            if response.status_code not in AGENT_RETRY_STATUSES or attempt == AGENT_RETRIES:
+                return response
+            
+            await response.aclose()
+            delay = AGENT_RETRY_BACKOFF * 2 ** attempt
+            logger.warning("  ⚠ Agent API returned %s, retrying in %.1fs", response.status_code, delay)
+            await asyncio.sleep(delay)
+    
+    async def _parse_agent_stream(self, response: httpx.Response) -> Dict:
+        """Incrementally parse an agent response, keeping only message_id and text content.
+        
+        A content item is only built up while it can still be a text item: as soon as
+        its "type" key turns out to be something else (tool calls and results), the
+        rest of its events are skipped. The agent sends "type" first, so large tool
+        results are never materialized.
+        """
+        message_id = None
+        content = []
+        builder = None
+        skipping = False
+        
+        def handle(events):
+            nonlocal message_id, builder, skipping
+            
+            for prefix, event, value in events:
+                if prefix == 'message_id' and event in ('string', 'number'):
+                    message_id = value
+                    continue
+                
+                if prefix == 'message.content.item' and event == 'start_map':
+                    builder, skipping = ijson.ObjectBuilder(), False
+                elif skipping:
+                    if prefix == 'message.content.item' and event == 'end_map':
+                        skipping = False
+                    continue
+                elif builder is None:
+                    continue
+                elif prefix == 'message.content.item.type' and value != 'text':
+                    builder, skipping = None, True
+                    continue
+                
+                builder.event(event, value)
+                if prefix == 'message.content.item' and event == 'end_map':
+                    if builder.value.get('type') == 'text':
+                        content.append(builder.value)
+                    builder = None
+            
+            del events[:]
+        
+        events = ijson.sendable_list()
+        parser = ijson.parse_coro(events, use_float=True)
+        
+        received = 0
+        async for chunk in response.aiter_bytes():
+            received += len(chunk)
+            if received > MAX_AGENT_RESPONSE_BYTES:
+                raise ValueError(
+                    f"Agent response exceeded {MAX_AGENT_RESPONSE_BYTES} bytes"
+                )
+            
+            parser.send(chunk)
+            handle(events)
+        
+        # Closing the parser can emit the final events
+        parser.close()
+        handle(events)
+        
+        parsed = {'message': {'content': content}}
+        if message_id is not None:
+            parsed['message_id'] = message_id
+        return parsed
     
     def extract_text_from_response(self, response: Dict) -> str:
         """Extract text content from agent response."""
-        text_parts = []
-        
-        if 'message' in response and 'content' in response['message']:
-            for content_item in response['message']['content']:
-                if content_item.get('type') == 'text':
-                    text_parts.append(content_item.get('text', ''))
+        content = response.get('message', {}).get('content', ())
         
-        return '\n\n'.join(text_parts)
+        return '\n\n'.join(
+            item.get('text', '') for item in content if item.get('type') == 'text'
+        )
     
-    def generate_report_for_customer(
+    async def generate_report_for_customer(
         self, 
         customer_id: str,
         week_start: datetime,
-        week_end: datetime
+        week_end: datetime,
+        sequential_sections: bool = False,
+        thread_key: Optional[str] = None
     ) -> Dict[str, str]:
-        """Generate a multi-section report for a specific customer."""
+        """Generate a multi-section report for a specific customer.
         
-        # Create a thread for this report generation
-        thread_id = self.create_thread()
-        print(f"Created thread: {thread_id}")
+        The section prompts are self-contained, so by default all sections are
+        requested concurrently from the thread root. Set sequential_sections to
+        chain them through parent_message_id so later sections see earlier ones.
+        
+        Pass thread_key (e.g. the CSM id) to share one thread among all reports with
+        the same key; otherwise a new thread is created for this customer. Either way
+        a thread is only created when at least one section misses the cache.
+        
+        Sections loaded by _prefetch_cached for the same customer and period are
+        reused instead of calling the agent; new responses are queued for the cache
+        and written by flush_reports().
+        """
         
-        # Define report sections and their prompts
+        # Fill in the section prompts for this customer and period
+        ws_str = week_start.strftime('%Y-%m-%d')
+        we_str = week_end.strftime('%Y-%m-%d')
         sections = {
-            'performance': f"""
-            Analyze performance vs industry benchmarks for customer {customer_id} 
-            for the period {week_start.strftime('%Y-%m-%d')} to {week_end.strftime('%Y-%m-%d')}.
-            
-            Include:
-            1. Key conversion metrics (total revenue, conversion count, average value)
-            2. Engagement metrics (open rates, click-through rates, engagement scores)
-            3. Comparison to industry benchmarks where available
-            4. Year-over-year comparison if sufficient historical data exists
-            
-            Keep it concise and highlight the most important metrics.
-            """,
-            
-            'business_value': f"""
-            Provide a business value analysis for customer {customer_id}.
-            
-            Focus on:
-            1. Revenue trends and growth indicators
-            2. Customer engagement health
-            3. Channel effectiveness (which channels are driving the most value)
-            4. Attribution insights (which touchpoints contribute most to conversions)
-            
-            Translate metrics into business impact statements.
-            """,
-            
-            'recommendations': f"""
-            Based on the data for customer {customer_id} and relevant case studies from 
-            the Media & Entertainment industry, provide 3-5 actionable recommendations.
-            
-            For each recommendation:
-            1. State the recommendation clearly
-            2. Reference supporting data or case study examples
-            3. Explain the expected impact
-            
-            Focus on: channel optimization, engagement strategies, and churn prevention.
-            """
+            section_name: template.format(customer_id=customer_id, ws=ws_str, we=we_str)
+            for section_name, template in _PROMPT_TEMPLATES.items()
         }
         
-        report_sections = {}
-        parent_message_id = "0"
+        cache_keys = {
+            section_name: self._cache_key(customer_id, week_start, week_end, section_name)
+            for section_name in sections
+        }
+        responses = {}
         
-        # Generate each section
-        for section_name, prompt in sections.items():
-            print(f"Generating {section_name} section...")
-            
-            response = self.call_agent(
-                thread_id=thread_id,
-                parent_message_id=parent_message_id,
-                user_message=prompt
-            )
+        if self.use_cache:
+            for section_name, key in cache_keys.items():
+                cached = self._cached_responses.get(key)
+                if cached is not None:
+                    logger.info("Using cached %s section for %s", section_name, customer_id)
+                    responses[section_name] = cached
+        
+        pending = {name: prompt for name, prompt in sections.items() if name not in responses}
+        
+        if pending:
+            thread_id = None
+            if thread_key is not None:
+                try:
+                    thread_id = await self._shared_thread(thread_key)
+                except Exception as e:
+                    logger.warning("  ⚠ Could not create shared thread for %s: %s", thread_key, e)
             
-            # Extract text from response
-            section_text = self.extract_text_from_response(response)
-            report_sections[section_name] = section_text
+            if thread_id is None:
+                # Create a thread for this report generation
+                thread_id = await self.create_thread()
+                logger.info("Created thread: %s", thread_id)
             
-            # Update parent_message_id for next call (maintains context)
-            parent_message_id = response.get('message_id', parent_message_id)
+            if sequential_sections:
+                parent_message_id = "0"
+                
+                # Generate each section
+                for section_name, prompt in pending.items():
+                    logger.info("Generating %s section for %s...", section_name, customer_id)
+                    
+                    response = await self.call_agent(
+                        thread_id=thread_id,
+                        parent_message_id=parent_message_id,
+                        user_message=prompt
+                    )
+                    responses[section_name] = response
+                    
+                    # Update parent_message_id for next call (maintains context)
+                    parent_message_id = response.get('message_id', parent_message_id)
+            else:
+                logger.info("Generating %s sections for %s...", ', '.join(pending), customer_id)
+                
+                tasks = [
+                    asyncio.ensure_future(self.call_agent(
+                        thread_id=thread_id,
+                        parent_message_id="0",
+                        user_message=prompt
+                    ))
+                    for prompt in pending.values()
+                ]
+                try:
+                    results = await asyncio.gather(*tasks)
+                except BaseException:
+                    # Don't leave sibling sections running once the report has failed
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    raise
+                responses.update(zip(pending, results))
             
-            print(f"  ✓ {section_name} section generated ({len(section_text)} chars)")
+            if self.use_cache:
+                for section_name in pending:
+                    self._pending_cache_rows[cache_keys[section_name]] = (
+                        orjson.dumps(responses[section_name]).decode()
+                    )
+        
+        # Extract text from responses
+        report_sections = {
+            section_name: self.extract_text_from_response(responses[section_name])
+            for section_name in sections
+        }
+        
+        for section_name, section_text in report_sections.items():
+            logger.info("  ✓ %s section generated (%d chars)", section_name, len(section_text))
         
         return report_sections
     
@@ -187,39 +520,16 @@ class WeeklyReportGenerator:
     ) -> str:
         """Format all sections into a complete report."""
         
-        report = f"""
-================================================================================
-WEEKLY EXECUTIVE REVIEW REPORT
-================================================================================
-
-Customer ID: {customer_id}
-CSM: {csm_name}
-Report Period: {week_start.strftime('%B %d, %Y')} - {week_end.strftime('%B %d, %Y')}
-Generated: {datetime.now().strftime('%B %d, %Y at %I:%M %p')}
-
-================================================================================
-1. PERFORMANCE VS BENCHMARKS
-================================================================================
-
-{sections['performance']}
-
-================================================================================
-2. BUSINESS VALUE ANALYSIS
-================================================================================
-
-{sections['business_value']}
-
-================================================================================
-3. RECOMMENDATIONS & BEST PRACTICES
-================================================================================
-
-{sections['recommendations']}
-
-================================================================================
-END OF REPORT
-================================================================================
-"""
-        return report
+        return _REPORT_SHELL.format(
+            customer_id=customer_id,
+            csm_name=csm_name,
+            week_start=week_start.strftime('%B %d, %Y'),
+            week_end=week_end.strftime('%B %d, %Y'),
+            generated=datetime.now().strftime('%B %d, %Y at %I:%M %p'),
+            performance=sections['performance'],
+            business_value=sections['business_value'],
+            recommendations=sections['recommendations']
+        )
     
     def save_report_to_database(
         self,
@@ -229,19 +539,14 @@ END OF REPORT
         week_end: datetime,
         sections: Dict[str, str],
         full_report: str
-    ) -> int:
-        """Save the generated report to the database."""
-        
-        cursor = self.conn.cursor()
+    ):
+        """Queue the generated report; it is written when flush_reports() is called.
         
-        insert_sql = """
-        INSERT INTO CUSTOMER_SUCCESS_DATA.ANALYTICS.weekly_reports 
-        (csm_id, customer_id, report_date, report_week_start, report_week_end, 
-         performance_section, business_value_section, recommendations_section, full_report)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        Nothing is written here, so calling this from the event loop never blocks
+        on Snowflake.
         """
         
-        cursor.execute(insert_sql, (
+        self._pending_rows.append((
             csm_id,
             customer_id,
             datetime.now().date(),
@@ -252,130 +557,237 @@ END OF REPORT
             sections['recommendations'],
             full_report
         ))
+    
+    def flush_reports(self) -> int:
+        """Insert all queued reports in batches of INSERT_BATCH_SIZE.
         
-        # Get the generated report_id
-        cursor.execute("SELECT LAST_QUERY_ID()")
+        Each batch is committed before it leaves the queue, so a failed insert keeps
+        the reports that have not been written yet. Returns the number of rows the
+        INSERTs reported writing; the running total is kept in saved_report_count.
+        """
         
-        cursor.close()
-        self.conn.commit()
+        cursor = self._cursor()
         
-        return cursor.rowcount
+        insert_sql = """
+        INSERT INTO CUSTOMER_SUCCESS_DATA.ANALYTICS.weekly_reports 
+        (csm_id, customer_id, report_date, report_week_start, report_week_end, 
+         performance_section, business_value_section, recommendations_section, full_report)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """
+        
+        inserted = 0
+        while self._pending_rows:
+            batch = self._pending_rows[:INSERT_BATCH_SIZE]
+            cursor.executemany(insert_sql, batch)
+            # Read rowcount before the cursor runs anything else
+            rowcount = cursor.rowcount
+            self.conn.commit()
+            del self._pending_rows[:len(batch)]
+            inserted += rowcount
+            self.saved_report_count += rowcount
+        
+        self._flush_cache()
+        
+        return inserted
     
     def get_csm_assignments(self) -> List[Dict]:
-        """Get all CSM assignments from the database."""
+        """Get all CSM assignments from the database.
+        
+        Empty and 'undefined' customer IDs are dropped in the query, so every
+        returned customer_ids list contains only valid IDs (possibly none).
+        """
         
-        cursor = self.conn.cursor()
+        cursor = self._cursor()
         cursor.execute("""
-            SELECT csm_id, csm_name, csm_email, assigned_customer_ids, region
-            FROM CUSTOMER_SUCCESS_DATA.ANALYTICS.csm_assignments
+            SELECT
+                a.csm_id,
+                a.csm_name,
+                a.csm_email,
+                ARRAY_AGG(IFF(f.value::STRING IN ('', 'undefined'), NULL, f.value::STRING))
+                    WITHIN GROUP (ORDER BY f.index),
+                a.region
+            FROM CUSTOMER_SUCCESS_DATA.ANALYTICS.csm_assignments a,
+                LATERAL FLATTEN(input => a.assigned_customer_ids, outer => TRUE) f
+            GROUP BY a.csm_id, a.csm_name, a.csm_email, a.region
         """)
         
         rows = cursor.fetchall()
-        cursor.close()
         
         csm_list = []
         for row in rows:
+            self._csm_names[row[0]] = row[1]
             csm_list.append({
                 'csm_id': row[0],
                 'csm_name': row[1],
                 'csm_email': row[2],
-                'customer_ids': json.loads(row[3]),  # Parse JSON array
+                'customer_ids': orjson.loads(row[3]),  # ARRAY columns arrive as JSON text
                 'region': row[4]
             })
         
         return csm_list
     
-    def generate_weekly_reports(self):
-        """Generate reports for all CSMs and their assigned customers."""
+    def _csm_name(self, csm_id: str) -> Optional[str]:
+        """Look up a CSM's name, querying Snowflake only the first time."""
+        if csm_id in self._csm_names:
+            return self._csm_names[csm_id]
+        
+        cursor = self._cursor()
+        cursor.execute(
+            "SELECT csm_name FROM CUSTOMER_SUCCESS_DATA.ANALYTICS.csm_assignments WHERE csm_id = %s",
+            (csm_id,)
+        )
+        result = cursor.fetchone()
+        
+        if not result:
+            return None
+        
+        self._csm_names[csm_id] = result[0]
+        return result[0]
+    
+    async def _process_customer(
+        self,
+        csm: Dict,
+        customer_id: str,
+        week_start: datetime,
+        week_end: datetime,
+        semaphore: asyncio.Semaphore,
+        thread_key: Optional[str] = None
+    ) -> bool:
+        """Generate, format and save the report for one customer."""
+        async with semaphore:
+            logger.info("  Generating report for customer: %s", customer_id)
+            
+            try:
+                # Generate report sections
+                sections = await self.generate_report_for_customer(
+                    customer_id=customer_id,
+                    week_start=week_start,
+                    week_end=week_end,
+                    thread_key=thread_key
+                )
+                
+                # Format full report
+                full_report = self.format_full_report(
+                    customer_id=customer_id,
+                    csm_name=csm['csm_name'],
+                    week_start=week_start,
+                    week_end=week_end,
+                    sections=sections
+                )
+                
+                # Queue for the batched database write
+                self.save_report_to_database(
+                    csm_id=csm['csm_id'],
+                    customer_id=customer_id,
+                    week_start=week_start,
+                    week_end=week_end,
+                    sections=sections,
+                    full_report=full_report
+                )
+                
+                logger.info("  ✓ Report generated for %s", customer_id)
+                return True
+                
+            except Exception as e:
+                # Timeouts and HTTP errors only fail this customer; the run continues
+                logger.error("  ✗ Error generating report for %s: %s: %s", customer_id, type(e).__name__, e)
+                return False
+    
+    async def generate_weekly_reports(self, max_concurrency: int = MAX_CONCURRENT_REPORTS):
+        """Generate reports for all CSMs and their assigned customers.
+        
+        Customers are processed concurrently, at most max_concurrency at a time.
+        All customers of a CSM share one agent thread, created on the CSM's first
+        cache miss, which saves a thread creation call per customer. Every prompt
+        names its customer and starts from the thread root, so reports do not see
+        each other's messages.
+        """
         
         # Calculate report period (last 7 days)
         week_end = datetime.now()
         week_start = week_end - timedelta(days=7)
         
-        print(f"\n{'='*80}")
-        print(f"WEEKLY REPORT GENERATION")
-        print(f"Period: {week_start.strftime('%Y-%m-%d')} to {week_end.strftime('%Y-%m-%d')}")
-        print(f"{'='*80}\n")
+        logger.info("=" * 80)
+        logger.info("WEEKLY REPORT GENERATION")
+        logger.info("Period: %s to %s", week_start.strftime('%Y-%m-%d'), week_end.strftime('%Y-%m-%d'))
+        logger.info("=" * 80)
         
         # Get all CSM assignments
         csms = self.get_csm_assignments()
         
-        report_count = 0
-        
-        for csm in csms:
-            print(f"\nProcessing CSM: {csm['csm_name']} ({csm['csm_id']})")
-            print(f"Region: {csm['region']}")
-            print(f"Assigned Customers: {len(csm['customer_ids'])}")
+        # Read all cached sections up front so no cache query blocks the event loop later
+        self._prefetch_cached([
+            self._cache_key(customer_id, week_start, week_end, section_name)
+            for csm in csms
+            for customer_id in csm['customer_ids']
+            for section_name in _PROMPT_TEMPLATES
+        ])
+        
+        semaphore = asyncio.Semaphore(max_concurrency)
+        saved_before = self.saved_report_count
+        
+        try:
+            tasks = []
+            for csm in csms:
+                logger.info("Processing CSM: %s (%s)", csm['csm_name'], csm['csm_id'])
+                logger.info("Region: %s", csm['region'])
+                logger.info("Assigned Customers: %d", len(csm['customer_ids']))
+                
+                tasks.extend(
+                    self._process_customer(
+                        csm, customer_id, week_start, week_end, semaphore,
+                        thread_key=csm['csm_id']
+                    )
+                    for customer_id in csm['customer_ids']
+                )
             
-            for customer_id in csm['customer_ids']:
-                if customer_id and customer_id != 'undefined':
-                    print(f"\n  Generating report for customer: {customer_id}")
-                    
-                    try:
-                        # Generate report sections
-                        sections = self.generate_report_for_customer(
-                            customer_id=customer_id,
-                            week_start=week_start,
-                            week_end=week_end
-                        )
-                        
-                        # Format full report
-                        full_report = self.format_full_report(
-                            customer_id=customer_id,
-                            csm_name=csm['csm_name'],
-                            week_start=week_start,
-                            week_end=week_end,
-                            sections=sections
-                        )
-                        
-                        # Save to database
-                        self.save_report_to_database(
-                            csm_id=csm['csm_id'],
-                            customer_id=customer_id,
-                            week_start=week_start,
-                            week_end=week_end,
-                            sections=sections,
-                            full_report=full_report
-                        )
-                        
-                        print(f"  ✓ Report saved to database")
-                        report_count += 1
-                        
-                    except Exception as e:
-                        print(f"  ✗ Error generating report for {customer_id}: {str(e)}")
-        
-        print(f"\n{'='*80}")
-        print(f"COMPLETED: Generated {report_count} reports")
-        print(f"{'='*80}\n")
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            # Shared threads are tasks bound to this event loop
+            self._shared_threads.clear()
+            try:
+                await self.aclose_client()
+            finally:
+                # Save whatever was generated, even if the run was interrupted
+                self.flush_reports()
+        
+        report_count = self.saved_report_count - saved_before
+        logger.info("✓ Saved %d reports to database", report_count)
+        
+        logger.info("=" * 80)
+        logger.info("COMPLETED: Generated %d reports", report_count)
+        logger.info("=" * 80)
     
-    def generate_single_report(self, csm_id: str, customer_id: str) -> str:
-        """Generate a single report for testing purposes."""
+    async def generate_single_report(self, csm_id: str, customer_id: str) -> Tuple[str, Dict[str, str], str]:
+        """Generate a single report for testing purposes.
+        
+        Returns the full report text, the individual sections and the CSM's name.
+        """
         
         week_end = datetime.now()
         week_start = week_end - timedelta(days=7)
         
         # Get CSM info
-        cursor = self.conn.cursor()
-        cursor.execute(
-            "SELECT csm_name FROM CUSTOMER_SUCCESS_DATA.ANALYTICS.csm_assignments WHERE csm_id = %s",
-            (csm_id,)
-        )
-        result = cursor.fetchone()
-        cursor.close()
-        
-        if not result:
+        csm_name = self._csm_name(csm_id)
+        if csm_name is None:
             raise ValueError(f"CSM {csm_id} not found")
         
-        csm_name = result[0]
+        logger.info("Generating report for %s (CSM: %s)...", customer_id, csm_name)
         
-        print(f"Generating report for {customer_id} (CSM: {csm_name})...")
+        self._prefetch_cached([
+            self._cache_key(customer_id, week_start, week_end, section_name)
+            for section_name in _PROMPT_TEMPLATES
+        ])
         
         # Generate sections
-        sections = self.generate_report_for_customer(
-            customer_id=customer_id,
-            week_start=week_start,
-            week_end=week_end
-        )
+        try:
+            sections = await self.generate_report_for_customer(
+                customer_id=customer_id,
+                week_start=week_start,
+                week_end=week_end
+            )
+        finally:
+            await self.aclose_client()
         
         # Format full report
         full_report = self.format_full_report(
@@ -395,14 +807,33 @@ END OF REPORT
             sections=sections,
             full_report=full_report
         )
+        self.flush_reports()
         
-        return full_report
+        return full_report, sections, csm_name
     
     def close(self):
-        """Close the Snowflake connection."""
+        """Close the shared cursor and the Snowflake connection."""
+        if self._cur is not None:
+            self._cur.close()
+            self._cur = None
         self.conn.close()
 
 
+def run_sync(coro):
+    """Run a coroutine to completion from synchronous code.
+    
+    Uses asyncio.run() directly, or a worker thread with its own event loop when
+    called where a loop is already running (Jupyter / Snowflake notebooks).
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+
 def main():
     """Main entry point for the script."""
     import argparse
@@ -416,17 +847,25 @@ def main():
                        help='Generate PDF report with charts (requires matplotlib and reportlab)')
     parser.add_argument('--pdf-output', default='executive_report.pdf',
                        help='Output path for PDF report')
+    parser.add_argument('--no-cache', action='store_true',
+                       help='Always call the agent instead of reusing cached section responses')
     
     args = parser.parse_args()
     
-    generator = WeeklyReportGenerator()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    # httpx logs every request at INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    
+    generator = WeeklyReportGenerator(use_cache=not args.no_cache)
     
     try:
         if args.mode == 'single':
             if not args.csm_id or not args.customer_id:
                 parser.error("--csm-id and --customer-id are required for single mode")
             
-            report = generator.generate_single_report(args.csm_id, args.customer_id)
+            report, report_sections, csm_name = run_sync(
+                generator.generate_single_report(args.csm_id, args.customer_id)
+            )
             print("\n" + "="*80)
             print("GENERATED REPORT:")
             print("="*80)
@@ -437,66 +876,30 @@ def main():
                 try:
                     from cortex_code_workbook.customer_success_use_case.pdf_report_generator import PDFReportGenerator
                     
-                    # Get CSM info
-                    cursor = generator.conn.cursor()
-                    cursor.execute(
-                        "SELECT csm_name FROM CUSTOMER_SUCCESS_DATA.ANALYTICS.csm_assignments WHERE csm_id = %s",
-                        (args.csm_id,)
-                    )
-                    result = cursor.fetchone()
-                    cursor.close()
+                    week_end = datetime.now()
+                    week_start = week_end - timedelta(days=7)
+                    
+                    pdf_gen = PDFReportGenerator()
+                    try:
+                        pdf_gen.generate_pdf_report(
+                            customer_id=args.customer_id,
+                            csm_name=csm_name,
+                            report_sections=report_sections,
+                            output_path=args.pdf_output,
+                            week_start=week_start,
+                            week_end=week_end
+                        )
+                        logger.info("✓ PDF report generated: %s", args.pdf_output)
+                    finally:
+                        pdf_gen.close()
                     
-                    if result:
-                        csm_name = result[0]
-                        
-                        # Get report sections from database
-                        cursor = generator.conn.cursor()
-                        cursor.execute("""
-                            SELECT performance_section, business_value_section, recommendations_section
-                            FROM CUSTOMER_SUCCESS_DATA.ANALYTICS.weekly_reports
-                            WHERE csm_id = %s AND customer_id = %s
-                            ORDER BY generation_timestamp DESC
-                            LIMIT 1
-                        """, (args.csm_id, args.customer_id))
-                        
-                        sections_row = cursor.fetchone()
-                        cursor.close()
-                        
-                        if sections_row:
-                            report_sections = {
-                                'performance': sections_row[0],
-                                'business_value': sections_row[1],
-                                'recommendations': sections_row[2]
-                            }
-                            
-                            week_end = datetime.now()
-                            week_start = week_end - timedelta(days=7)
-                            
-                            pdf_gen = PDFReportGenerator()
-                            try:
-                                pdf_gen.generate_pdf_report(
-                                    customer_id=args.customer_id,
-                                    csm_name=csm_name,
-                                    report_sections=report_sections,
-                                    output_path=args.pdf_output,
-                                    week_start=week_start,
-                                    week_end=week_end
-                                )
-                                print(f"\n✓ PDF report generated: {args.pdf_output}")
-                            finally:
-                                pdf_gen.close()
-                        else:
-                            print("\n⚠ No report sections found in database for PDF generation")
-                    else:
-                        print("\n⚠ CSM not found for PDF generation")
-                        
                 except ImportError as e:
-                    print(f"\n⚠ PDF generation requires additional packages: {e}")
-                    print("   Install with: pip install matplotlib reportlab")
+                    logger.warning("⚠ PDF generation requires additional packages: %s", e)
+                    logger.warning("   Install with: pip install matplotlib reportlab")
                 except Exception as e:
-                    print(f"\n✗ Error generating PDF: {e}")
+                    logger.error("✗ Error generating PDF: %s", e)
         else:
-            generator.generate_weekly_reports()
+            run_sync(generator.generate_weekly_reports())
     
     finally:
         generator.close()